@@ -0,0 +1,74 @@
+import struct
+
+MAGIC = b'JCKP'
+VERSION = 1
+# magic, version, interval (in MCU rows), length of the file, offset of the scan data in the file,
+# length of the unstuffed scan data, number of MCU rows, number of MCU columns, number of components
+HEADER = struct.Struct('>4sBHIIIHHB')
+
+class Checkpoint:
+    def __init__(self, mcu_row, pos, bitpos, prev_DCs):
+        self.mcu_row = mcu_row # the first MCU row decoded from this checkpoint
+        # position in the unstuffed stream, see Stream
+        self.pos = pos
+        self.bitpos = bitpos
+        self.prev_DCs = prev_DCs # prev_DC of each component, in scan order
+
+class CheckpointIndex:
+    """entropy decoder state recorded every `interval` MCU rows of a sequential scan,
+    so that a later decode can start at any checkpoint instead of the first MCU"""
+    def __init__(self, interval, layout, component_ids):
+        self.interval = interval
+        # (file_length, scan_offset, scan_length, nr_MCUs_ver, nr_MCUs_hor),
+        # identify the scan the checkpoints belong to, see Decoder.scan_layout
+        self.layout = layout
+        self.component_ids = component_ids
+        self.checkpoints = []
+
+    def add(self, mcu_row, stream, interleaved_components):
+        prev_DCs = [cp.prev_DC for cp in interleaved_components]
+        self.checkpoints.append(Checkpoint(mcu_row, stream.pos, stream.bitpos, prev_DCs))
+
+    def nearest(self, mcu_row):
+        """return the last checkpoint at or before mcu_row, None if there is none"""
+        res = None
+        for checkpoint in self.checkpoints:
+            if checkpoint.mcu_row > mcu_row: break
+            res = checkpoint
+        return res
+
+    def to_bytes(self):
+        n = len(self.component_ids)
+        entry = struct.Struct('>HIB' + 'h' * n)
+        data = [HEADER.pack(MAGIC, VERSION, self.interval, *self.layout, n)]
+        data.append(bytes(self.component_ids))
+        data.append(struct.pack('>I', len(self.checkpoints)))
+        for c in self.checkpoints:
+            data.append(entry.pack(c.mcu_row, c.pos, c.bitpos, *c.prev_DCs))
+        return b''.join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, interval, *layout, n = HEADER.unpack_from(data, 0)
+        assert magic == MAGIC, "Not a checkpoint index"
+        assert version == VERSION, f"Unsupported checkpoint index version {version}"
+        offset = HEADER.size
+        index = cls(interval, tuple(layout), list(data[offset:offset+n]))
+        offset += n
+        nr_checkpoints, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        entry = struct.Struct('>HIB' + 'h' * n)
+        for _ in range(nr_checkpoints):
+            mcu_row, pos, bitpos, *prev_DCs = entry.unpack_from(data, offset)
+            index.checkpoints.append(Checkpoint(mcu_row, pos, bitpos, prev_DCs))
+            offset += entry.size
+        return index
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
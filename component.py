@@ -14,8 +14,13 @@ class Component:
         # so they are equal to number of MCU rows and number of MCU columns respectively
         self.nr_blocks_ver = 0 
         self.nr_blocks_hor = 0 
-        # a 3d array to store coefficients, row * col * 64
+        # a 3d array to store coefficients, row * col * 64, rows and columns may be more when it is pooled
         self.blocks = None 
+        # a 2d array of bitmaps, bit k is set if blocks[i][j][k] != 0,
+        # kept by progressive AC scans so that refinement can skip zero coefficients
+        self.nonzero = None
+        # a 4d array to store the 8 * 8 matrix of each block after dezigzag and IDCT, row * col * 8 * 8
+        self.planes = None
         
         # may change when scanning
         self.prev_DC = 0
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from huffman import create_huffman_tree
+from stream import Stream
+from utils import create_nd_array, fill_nd_array
+
+def size_class(n):
+    """round n up to a size class, there are 8 classes between two powers of 2,
+    so a class is at most 1/8 larger than n"""
+    step = 1 << max(0, n.bit_length() - 4)
+    return -(-n // step) * step
+
+class BufferPool:
+    """arrays created by create_nd_array, kept by size class after use,
+    so that the next image of a similar size reuses them instead of allocating.
+    The first two dimensions of an array are rounded up to a size class, so an array may be larger than asked for,
+    users must loop over the real size rather than len() of the array"""
+    def __init__(self, max_free = 64):
+        self.free = OrderedDict() # size class -> list of arrays, least recently used first
+        self.nr_free = 0
+        self.max_free = max_free # the most arrays kept in free, the least recently used are dropped
+        self.in_use = [] # (size class, array) acquired since the last release
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.high_water = 0 # the most arrays in use at the same time
+
+    def acquire(self, shape, clear = True):
+        """return an array at least as large as the shape, a reused one is filled with 0 unless clear is False,
+        which is for arrays that are fully overwritten before read"""
+        key = tuple(size_class(n) for n in shape[:2]) + tuple(shape[2:])
+        free = self.free.get(key)
+        if free:
+            self.hits += 1
+            array = free.pop()
+            self.nr_free -= 1
+            if not free: del self.free[key]
+            if clear: fill_nd_array(array, 0)
+        else:
+            self.misses += 1
+            array = create_nd_array(key)
+        self.in_use.append((key, array))
+        if len(self.in_use) > self.high_water: self.high_water = len(self.in_use)
+        return array
+
+    def release_all(self):
+        for key, array in self.in_use:
+            self.free.setdefault(key, []).append(array)
+            self.free.move_to_end(key)
+            self.nr_free += 1
+        self.in_use = []
+        while self.nr_free > self.max_free:
+            key, free = next(iter(self.free.items()))
+            free.pop()
+            self.nr_free -= 1
+            self.evictions += 1
+            if not free: del self.free[key]
+
+class DecoderContext:
+    """state shared by Decoders that decode images one after another,
+    call reset() after an image is done, the arrays of that image (including decoder.data) are then reused"""
+    def __init__(self, max_tables = 16):
+        self.pool = BufferPool()
+        # least recently used first, each keeps at most max_tables tables
+        self.max_tables = max_tables
+        self.huffman_tables = OrderedDict() # (bits, huffvals) -> Huffman tree
+        self.quantization_tables = OrderedDict() # qt -> qt
+        self.table_hits = 0
+        self.table_misses = 0
+        self.__stream = Stream()
+
+    def reset(self):
+        self.pool.release_all()
+        # a failed decode may stop in the middle of a codeword
+        for tree in self.huffman_tables.values():
+            tree.reset()
+
+    def stream(self):
+        self.__stream.reset()
+        return self.__stream
+
+    def huffman_table(self, bits, huffvals):
+        key = (tuple(bits), tuple(huffvals))
+        if key in self.huffman_tables:
+            self.table_hits += 1
+            self.huffman_tables[key].reset()
+        else:
+            self.table_misses += 1
+            self.huffman_tables[key] = create_huffman_tree(bits, huffvals)
+        return self.__use(self.huffman_tables, key)
+
+    def quantization_table(self, qt):
+        key = tuple(qt)
+        if key in self.quantization_tables:
+            self.table_hits += 1
+        else:
+            self.table_misses += 1
+            self.quantization_tables[key] = qt
+        return self.__use(self.quantization_tables, key)
+
+    def __use(self, tables, key):
+        """mark the table as the most recently used, drop the least recently used ones over max_tables"""
+        tables.move_to_end(key)
+        while len(tables) > self.max_tables:
+            tables.popitem(last=False)
+        return tables[key]
+
+    def stats(self):
+        return {
+            "pool_hits": self.pool.hits,
+            "pool_misses": self.pool.misses,
+            "pool_high_water": self.pool.high_water,
+            "pool_free": self.pool.nr_free,
+            "pool_evictions": self.pool.evictions,
+            "table_hits": self.table_hits,
+            "table_misses": self.table_misses,
+            "huffman_tables": len(self.huffman_tables),
+            "quantization_tables": len(self.quantization_tables),
+        }
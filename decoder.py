@@ -1,15 +1,24 @@
 from marker import *
-from huffman import create_huffman_tree
 import numpy as np
 from utils import *
 from PIL import Image
+import sys
 import time
 import math
-from stream import Stream
 from component import Component
+from stream import Stream
+from checkpoint import CheckpointIndex
+from context import DecoderContext
 
 class Decoder:
-    def __init__(self, filename : str):
+    def __init__(self, filename : str, checkpoint_interval = 0, index = None, mcu_rows = None, context = None):
+        """checkpoint_interval: record a checkpoint every n MCU rows of a sequential scan, 0 for none
+        index: a CheckpointIndex of this file, used to start decoding at the nearest checkpoint
+        mcu_rows: (start, stop), only reconstruct and save these MCU rows, a sequential scan is
+        entropy-decoded from the nearest checkpoint before start and stops at stop
+        context: a DecoderContext shared with other decoders to reuse arrays and tables"""
+        # a resumed decode skips the rows before the checkpoint, so it cannot record them
+        assert index is None or checkpoint_interval == 0, "Cannot record checkpoints while resuming from an index"
         self.filename = filename
         self.__buffer = open(filename, 'rb').read()
         self.pos = 0
@@ -29,12 +38,20 @@ class Decoder:
         self.stuffed_width = 0
 
         self.stream = None
-        self.data = None
+        self.scan_offset = 0 # offset of the entropy-encoded data of the current scan in the file
+        self.data = None # pixels, stuffed_height * stuffed_width * 3, a pooled array may be larger
+
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoints = None # CheckpointIndex recorded while decoding
+        self.index = index
+        self.mcu_rows = mcu_rows
+        self.context = context if context is not None else DecoderContext()
 
     def init_stream(self):
         """read entroy-encoded data between SOS and the next marker to the stream,
         remove byte padding 0x00, which follows a 0xff"""
-        stream = Stream()
+        self.scan_offset = self.pos
+        stream = self.context.stream()
         while True:
             x = self.read_1b()
             if x != 0xff:
@@ -141,6 +158,8 @@ class Decoder:
         """pos is end of marker"""
         length = self.read_2b()
         self.mode = mode
+        # checkpoints are only recorded for sequential scans
+        assert self.index is None or mode == SOF0, "Index does not belong to this file"
         sample_precision = self.read_1b() # almost always be 8
         assert sample_precision == 8, "Only precision 8 is supported"
         height = self.read_2b()
@@ -170,7 +189,10 @@ class Decoder:
             cp.block_width = 8 * max_hf // cp.hf
             cp.nr_blocks_ver = math.ceil(self.height/cp.block_height)
             cp.nr_blocks_hor = math.ceil(self.width/cp.block_width)
-            cp.blocks = create_nd_array([self.stuffed_height//cp.block_height, self.stuffed_width//cp.block_width,64])
+            nr_rows, nr_cols = self.stuffed_height//cp.block_height, self.stuffed_width//cp.block_width
+            cp.blocks = self.context.pool.acquire([nr_rows, nr_cols, 64])
+            cp.nonzero = self.context.pool.acquire([nr_rows, nr_cols])
+            cp.planes = self.context.pool.acquire([nr_rows, nr_cols, 8, 8], clear=False)
 
     def read_huffman_table(self):
         length = self.read_2b()
@@ -187,7 +209,7 @@ class Decoder:
             for _ in range(nr_codewords):
                 huffvals.append(self.read_1b())
             # print("huffvals:", huffvals)
-            huffman_tree = create_huffman_tree(bits, huffvals)
+            huffman_tree = self.context.huffman_table(bits, huffvals)
             if table_class == 1:
                 self.ac_ht[ht_identifier] = huffman_tree
             else:
@@ -205,12 +227,12 @@ class Decoder:
                 qt = []
                 for _ in range(64):
                     qt.append(self.read_1b())
-                self.qts[identifier] = qt
+                self.qts[identifier] = self.context.quantization_table(qt)
             elif precision == 1:
                 qt = []
                 for _ in range(64):
                     qt.append(self.read_2b())
-                self.qts[identifier] = qt
+                self.qts[identifier] = self.context.quantization_table(qt)
 
     def read_scan(self):
         length = self.read_2b()
@@ -246,7 +268,13 @@ class Decoder:
     def decode_sequential(self, interleaved_components):
         """Most sequential encoding is interleaved, here it doesn't support non-interleaved"""
         for cp in interleaved_components: cp.prev_DC = 0
-        for i in range(self.nr_MCUs_ver):
+        start, stop = self.mcu_row_range()
+        first_row = self.seek_checkpoint(interleaved_components, start)
+        if self.checkpoint_interval:
+            self.checkpoints = CheckpointIndex(self.checkpoint_interval, self.scan_layout(), [cp.id for cp in interleaved_components])
+        for i in range(first_row, stop):
+            if self.checkpoint_interval and i % self.checkpoint_interval == 0:
+                self.checkpoints.add(i, self.stream, interleaved_components)
             for j in range(self.nr_MCUs_hor):
                 for cp in interleaved_components:
                     v_idx, h_idx = cp.vf * i, cp.hf * j # top-left block
@@ -255,6 +283,30 @@ class Decoder:
                             block = cp.blocks[v_idx+m][h_idx+n]
                             cp.prev_DC = self.decode_sequential_per_block(cp.DCht, cp.ACht, block, cp.prev_DC)
 
+    def mcu_row_range(self):
+        """(start, stop) of the MCU rows to decode, all rows unless mcu_rows is given"""
+        if self.mcu_rows is None: return 0, self.nr_MCUs_ver
+        start, stop = self.mcu_rows
+        return start, min(stop, self.nr_MCUs_ver)
+
+    def scan_layout(self):
+        """identify the current scan of this file, stored in a CheckpointIndex"""
+        return (len(self.__buffer), self.scan_offset, len(self.stream.buffer), self.nr_MCUs_ver, self.nr_MCUs_hor)
+
+    def seek_checkpoint(self, interleaved_components, mcu_row):
+        """restore the stream position and prev_DCs from the nearest checkpoint at or before mcu_row,
+        return the MCU row to continue decoding from"""
+        checkpoint = self.index.nearest(mcu_row) if self.index else None
+        if checkpoint is None: return 0
+        assert self.index.layout == self.scan_layout(), "Index does not belong to this file"
+        assert self.index.component_ids == [cp.id for cp in interleaved_components], "Index does not match the scan"
+        print(f"resume from checkpoint at MCU row {checkpoint.mcu_row}")
+        self.stream.pos = checkpoint.pos
+        self.stream.bitpos = checkpoint.bitpos
+        for cp, prev_DC in zip(interleaved_components, checkpoint.prev_DCs):
+            cp.prev_DC = prev_DC
+        return checkpoint.mcu_row
+
     def decode_sequential_per_block(self, DCht, ACht, block, prev_DC):
         DC_size = self.read_huffman_symbol(DCht)
         newDC = self.read_n_bits(DC_size) + prev_DC
@@ -312,13 +364,15 @@ class Decoder:
         for i in range(cp.nr_blocks_ver):
             for j in range(cp.nr_blocks_hor):
                 block = cp.blocks[i][j]
-                length_EOB_run = self.decode_ACs_progressive_first_per_block(cp.ACht, block, Ss, Se, Al, length_EOB_run)
+                length_EOB_run, cp.nonzero[i][j] = self.decode_ACs_progressive_first_per_block(
+                    cp.ACht, block, cp.nonzero[i][j], Ss, Se, Al, length_EOB_run)
 
-    def decode_ACs_progressive_first_per_block(self, ACht, block, Ss, Se, Al, length_EOB_run):
-        """the first scan of successive approximation or spectral selection only"""
+    def decode_ACs_progressive_first_per_block(self, ACht, block, nonzero, Ss, Se, Al, length_EOB_run):
+        """the first scan of successive approximation or spectral selection only,
+        return the length of EOB run and the updated non-zero bitmap"""
         # this is a EOB
         if length_EOB_run > 0:
-            return length_EOB_run - 1
+            return length_EOB_run - 1, nonzero
 
         idx = Ss
         while idx <= Se:
@@ -329,61 +383,79 @@ class Decoder:
                 if RUNLENGTH == 15: # ZRL(15,0)
                     idx += 16
                 else: # EOBn, n=0-14
-                    return self.read_n_bits(RUNLENGTH, False) + (2**RUNLENGTH) - 1
+                    return self.read_n_bits(RUNLENGTH, False) + (2**RUNLENGTH) - 1, nonzero
             else:
                 idx += RUNLENGTH
                 block[idx] = self.read_n_bits(SIZE) << Al
+                nonzero |= 1 << idx
                 idx += 1
-        return 0
+        return 0, nonzero
 
     def decode_ACs_progressive_subsequent(self, interleaved_components, Ss, Se, Al):
         cp = interleaved_components[0]
-        length_EOB_run = 0
-        for i in range(self.nr_MCUs_ver):
-            for j in range(self.nr_MCUs_hor):
-                block = cp.blocks[i][j]
-                length_EOB_run = self.decode_ACs_progressive_subsequent_per_block(cp.ACht, block, Ss, Se, Al, length_EOB_run)
-
-    def decode_ACs_progressive_subsequent_per_block(self, ACht, block, Ss, Se, Al, length_EOB_run):
+        band = (1 << (Se + 1)) - (1 << Ss) # bits Ss~Se
+        nr_blocks = self.nr_MCUs_ver * self.nr_MCUs_hor
+        k = 0 # index of block, row-major
+        while k < nr_blocks:
+            i, j = divmod(k, self.nr_MCUs_hor)
+            length_EOB_run, cp.nonzero[i][j] = self.decode_ACs_progressive_subsequent_per_block(
+                cp.ACht, cp.blocks[i][j], cp.nonzero[i][j], Ss, Se, Al)
+            k += 1
+            if length_EOB_run > 0:
+                end = min(k + length_EOB_run, nr_blocks)
+                self.refine_EOB_run(cp, k, end, band, Al)
+                k = end
+
+    def decode_ACs_progressive_subsequent_per_block(self, ACht, block, nonzero, Ss, Se, Al):
+        """return the number of following blocks in the EOB run and the updated non-zero bitmap,
+        bit k of the bitmap is set if block[k] != 0"""
         idx = Ss
-        # this is a EOB
-        if length_EOB_run > 0:
-            while idx <= Se:
-                if block[idx] != 0:
-                    self.refineAC(block, idx, Al)
-                idx += 1
-            return length_EOB_run - 1
-
         while idx <= Se:
             symbol = self.read_huffman_symbol(ACht)
             RUNLENGTH, SIZE = symbol >> 4, symbol % (2**4)
             if SIZE == 1: # zero history
                 val = self.read_n_bits(SIZE) << Al
-                while RUNLENGTH > 0 or block[idx] != 0:
-                    if block[idx] != 0:
-                        self.refineAC(block, idx, Al)
-                    else:
-                        RUNLENGTH -= 1
-                    idx += 1
-                block[idx] = val
-                idx += 1
+                # skip RUNLENGTH zero coefficients, the new one is the next zero coefficient,
+                # the non-zero coefficients skipped over get correction bits
+                new_idx = nth_zero_bit(nonzero, idx, RUNLENGTH)
+                self.refine_block(block, nonzero & ((1 << new_idx) - (1 << idx)), Al)
+                block[new_idx] = val
+                nonzero |= 1 << new_idx
+                idx = new_idx + 1
             elif SIZE == 0:
                 if RUNLENGTH < 15: # EOBn, n=0-14 
                     # !!! read EOB run first
                     newEOBrun = self.read_n_bits(RUNLENGTH, False) + (1<<RUNLENGTH)
-                    while idx <= Se:
-                        if block[idx] != 0:
-                            self.refineAC(block, idx, Al)
-                        idx += 1
-                    return newEOBrun - 1
-                else: # ZRL(15,0)
-                    while RUNLENGTH >= 0:
-                        if block[idx] != 0:
-                            self.refineAC(block, idx, Al)
-                        else:
-                            RUNLENGTH -= 1
-                        idx += 1
-        return 0
+                    # the remaining non-zero coefficients in the band get correction bits
+                    self.refine_block(block, nonzero & ((1 << (Se + 1)) - (1 << idx)), Al)
+                    return newEOBrun - 1, nonzero
+                else: # ZRL(15,0), skip 16 zero coefficients
+                    new_idx = nth_zero_bit(nonzero, idx, 15)
+                    self.refine_block(block, nonzero & ((1 << new_idx) - (1 << idx)), Al)
+                    idx = new_idx + 1
+        return 0, nonzero
+
+    def refine_EOB_run(self, cp, start, end, band, Al):
+        """blocks start~end-1 are in an EOB run, each non-zero coefficient in the band gets a correction bit,
+        the correction bits of a block are read at once"""
+        for k in range(start, end):
+            i, j = divmod(k, self.nr_MCUs_hor)
+            mask = cp.nonzero[i][j] & band
+            if mask: self.refine_block(cp.blocks[i][j], mask, Al)
+
+    def refine_block(self, block, mask, Al):
+        """each coefficient whose bit is set in mask gets a correction bit, in increasing order,
+        the correction bits are read at once"""
+        if mask == 0: return
+        nr_bits = bin(mask).count('1')
+        bits = self.stream.read_bits(nr_bits)
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            nr_bits -= 1
+            if bits >> nr_bits & 1:
+                idx = low.bit_length() - 1
+                block[idx] += (1 << Al) if block[idx] > 0 else (-1) << Al
 
     def refineAC(self, block, idx, Al):
         val = block[idx]
@@ -395,38 +467,46 @@ class Decoder:
                 block[idx] += (-1) << Al
             
     def reverse_quantization(self):
+        start, stop = self.mcu_row_range()
         for cp in self.components.values():
-            for i in range(cp.nr_blocks_ver):
+            for i in range(cp.vf * start, min(cp.vf * stop, cp.nr_blocks_ver)):
                 for j in range(cp.nr_blocks_hor):
                     for k in range(64):
                         cp.blocks[i][j][k] *= cp.qt[k]
 
 
     def reverse_zigzag(self):
+        start, stop = self.mcu_row_range()
         for cp in self.components.values():
-            for i in range(self.stuffed_height // cp.block_height):
+            for i in range(cp.vf * start, min(cp.vf * stop, self.stuffed_height // cp.block_height)):
                 for j in range(self.stuffed_width // cp.block_width):
             # for i in range(cp.nr_blocks_ver):
             #     for j in range(cp.nr_blocks_hor):
-                    cp.blocks[i][j] = zigzag2matrix(cp.blocks[i][j])
+                    zigzag2matrix(cp.blocks[i][j], cp.planes[i][j])
 
     def reverse_DCT(self):
         """cost the most time"""
+        F = self.context.pool.acquire([8,8], clear=False)
+        start, stop = self.mcu_row_range()
         for cp in self.components.values():
-            for i in range(cp.nr_blocks_ver):
+            for i in range(cp.vf * start, min(cp.vf * stop, cp.nr_blocks_ver)):
                 for j in range(cp.nr_blocks_hor):
-                    cp.blocks[i][j] = IDCT_matrix(cp.blocks[i][j])
+                    plane = cp.planes[i][j]
+                    for u in range(8):
+                        F[u][:] = plane[u]
+                    IDCT_matrix(F, plane)
 
     # it is the hardest for programming...
     def reverse_split_block(self):
-        pixels = create_nd_array([self.stuffed_height, self.stuffed_width, 3])
+        pixels = self.context.pool.acquire([self.stuffed_height, self.stuffed_width, 3])
+        start, stop = self.mcu_row_range()
         cp_idx = 0
         for cp in self.components.values():
-            for i in range(self.nr_MCUs_ver):
+            for i in range(start, stop):
                 for j in range(self.nr_MCUs_hor):
                     for u in range(cp.vf):
                         for v in range(cp.hf):
-                            block = cp.blocks[i*cp.vf+u][j*cp.hf+v]
+                            block = cp.planes[i*cp.vf+u][j*cp.hf+v]
                             # (v_idx, h_idx) top-left corner of pixel block
                             v_idx = i * self.MCU_height + u * cp.block_height
                             h_idx = j * self.MCU_width + v * cp.block_width
@@ -448,7 +528,57 @@ class Decoder:
     def save(self):
         array = np.array(self.data, dtype=np.uint8)
         new_image = Image.fromarray(array, 'YCbCr')
-        new_image.crop((0,0,self.width,self.height)).save("new" + self.filename)
+        start, stop = self.mcu_row_range()
+        top, bottom = start * self.MCU_height, min(stop * self.MCU_height, self.height)
+        new_image.crop((0,top,self.width,bottom)).save("new" + self.filename)
+
+def random_EOB_run(nr_blocks, Ss, Se, Al):
+    """a decoder with an EOB run of random blocks in the band Ss~Se and random correction bits,
+    only the state used by refinement is set up, no file is read"""
+    import random
+    decoder = Decoder.__new__(Decoder)
+    decoder.nr_MCUs_hor = 100
+    cp = Component(1, 1, None, 1)
+    nr_rows = math.ceil(nr_blocks / decoder.nr_MCUs_hor)
+    cp.blocks = create_nd_array([nr_rows, decoder.nr_MCUs_hor, 64])
+    cp.nonzero = create_nd_array([nr_rows, decoder.nr_MCUs_hor])
+    for k in range(nr_blocks):
+        i, j = divmod(k, decoder.nr_MCUs_hor)
+        for idx in random.sample(range(Ss, Se + 1), 10):
+            cp.blocks[i][j][idx] = random.choice([-1, 1]) * (random.randint(1, 100) << Al + 1)
+            cp.nonzero[i][j] |= 1 << idx
+    decoder.stream = Stream()
+    decoder.stream.buffer = [random.randint(0, 255) for _ in range(nr_blocks * 10 // 8 + 1)]
+    return decoder, cp
+
+def refine_EOB_run_by_refineAC(decoder, cp, nr_blocks, Ss, Se, Al):
+    """reference of refine_EOB_run, one coefficient at a time"""
+    for k in range(nr_blocks):
+        i, j = divmod(k, decoder.nr_MCUs_hor)
+        for idx in range(Ss, Se + 1):
+            if cp.blocks[i][j][idx] != 0:
+                decoder.refineAC(cp.blocks[i][j], idx, Al)
+
+def test_refine_EOB_run(nr_blocks = 32767, Ss = 1, Se = 63, Al = 1):
+    """refine a long EOB run, compare with refineAC"""
+    decoder, cp = random_EOB_run(nr_blocks, Ss, Se, Al)
+    expected = [[block[:] for block in row] for row in cp.blocks]
+    reference = Component(1, 1, None, 1)
+    reference.blocks = expected
+    refine_EOB_run_by_refineAC(decoder, reference, nr_blocks, Ss, Se, Al)
+    decoder.stream.pos, decoder.stream.bitpos = 0, 7
+    decoder.refine_EOB_run(cp, 0, nr_blocks, (1 << (Se + 1)) - (1 << Ss), Al)
+    assert cp.blocks == expected
+
+def time_refine_EOB_run(nr_blocks = 32767, Ss = 1, Se = 63, Al = 1):
+    decoder, cp = random_EOB_run(nr_blocks, Ss, Se, Al)
+    start_time = time.time()
+    refine_EOB_run_by_refineAC(decoder, cp, nr_blocks, Ss, Se, Al)
+    print("refineAC:", time.time()-start_time)
+    decoder, cp = random_EOB_run(nr_blocks, Ss, Se, Al)
+    start_time = time.time()
+    decoder.refine_EOB_run(cp, 0, nr_blocks, (1 << (Se + 1)) - (1 << Ss), Al)
+    print("refine_EOB_run:", time.time()-start_time)
 
 SEQ = 'testseq.jpg'
 PROG = 'testprog.jpg'
@@ -457,5 +587,9 @@ def decode(filename : str = SEQ):
     decoder = Decoder(filename)
     decoder.print_marker()
     decoder.run()
-decode()
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    test_refine_EOB_run()
+    time_refine_EOB_run()
+else:
+    decode()
 
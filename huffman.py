@@ -14,6 +14,10 @@ class Node:
         else:
             self.prev = node
             return None
+
+    def reset(self):
+        """go back to the root, drop a partly read codeword"""
+        self.prev = self
      
     def print_tree(self):
         maps = {}
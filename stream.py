@@ -4,6 +4,11 @@ class Stream:
         self.bitpos = 7 # msb 7, lsb 0
         self.buffer = []
 
+    def reset(self):
+        self.pos = 0
+        self.bitpos = 7
+        self.buffer.clear()
+
     def write_byte(self, val):
         self.buffer.append(val)
     
@@ -12,4 +17,19 @@ class Stream:
         bit = (self.buffer[self.pos] & mask) >> self.bitpos
         self.bitpos = (self.bitpos - 1) % 8
         if self.bitpos == 7: self.pos += 1
-        return bit
\ No newline at end of file
+        return bit
+
+    def read_bits(self, n):
+        """read n bits at once, return them as an unsigned number, msb first"""
+        res = 0
+        while n > 0:
+            avail = self.bitpos + 1 # bits left in the current byte
+            take = min(avail, n)
+            shift = avail - take
+            res = (res << take) | ((self.buffer[self.pos] >> shift) & ((1 << take) - 1))
+            n -= take
+            self.bitpos -= take
+            if self.bitpos < 0:
+                self.bitpos = 7
+                self.pos += 1
+        return res
\ No newline at end of file
@@ -8,6 +8,15 @@ def create_nd_array(shape):
         res.append(create_nd_array(shape[1:]))
     return res
 
+def fill_nd_array(array, val):
+    """fill an array created by create_nd_array with val in place"""
+    if isinstance(array[0], list):
+        for sub in array:
+            fill_nd_array(sub, val)
+    else:
+        for k in range(len(array)):
+            array[k] = val
+
 # CCIR Recommendation 601
 def RGBtoYCbCr(R, G, B):
     Y = 0.299 * R + 0.587*G + 0.114*B
@@ -40,8 +49,9 @@ def FDCT(f, u, v):
             res += f[x][y] * math.cos(math.pi*u*(2*x+1)/16) * math.cos(math.pi*v*(2*y+1)/16)
     return res * alpha(u) * alpha(v)
 
-def IDCT_matrix(F):
-    f = create_nd_array([8,8])
+def IDCT_matrix(F, f = None):
+    """write to f if it is given, f must not be F"""
+    if f is None: f = create_nd_array([8,8])
     for x in range(8):
         for y in range(8):
             f[x][y] = clip(round(IDCT(F, x, y))+128)
@@ -85,6 +95,13 @@ def bits_to_number(bits):
         res = res * 2 + x
     return res
 
+def nth_zero_bit(bits, idx, n):
+    """the position of the n-th (from 0) unset bit at or above idx in a 64-bit bitmap"""
+    zeros = ((1 << 64) - 1 - bits) >> idx << idx
+    for _ in range(n):
+        zeros &= zeros - 1 # clear the lowest set bit
+    return (zeros & -zeros).bit_length() - 1
+
 def construct_zigzag():
     zigzag = []
     bl2tr = True # bottom-left to top-right
@@ -109,9 +126,9 @@ def construct_zigzag():
 # zigzag[k] -> [i,j], k is the index in zigzag order, i, j are the indexs in the matrix
 zigzag = construct_zigzag()
 
-def zigzag2matrix(li):
-    """convert a list of size 64 in zigzag order to a 8 by 8 matrix"""
-    matrix = create_nd_array([8,8])
+def zigzag2matrix(li, matrix = None):
+    """convert a list of size 64 in zigzag order to a 8 by 8 matrix, write to matrix if it is given"""
+    if matrix is None: matrix = create_nd_array([8,8])
     for i, val in enumerate(li):
         x, y = zigzag[i]
         matrix[x][y] = val